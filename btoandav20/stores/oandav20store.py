@@ -5,8 +5,14 @@ import collections
 import threading
 import copy
 import time as _time
+import types
 from datetime import datetime, timezone
 
+try:
+    import ujson as json  # installed along with v20
+except ImportError:
+    import json
+
 import v20
 
 import backtrader as bt
@@ -46,6 +52,25 @@ class SerializableEvent(object):
             self.evt.set()
 
 
+class SerializableLock(object):
+    '''A threading.Lock that can be serialized.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self.lock.__enter__()
+
+    def __exit__(self, *args):
+        return self.lock.__exit__(*args)
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, d):
+        self.lock = threading.Lock()
+
+
 class MetaSingleton(MetaParams):
     '''Metaclass to make a metaclassed class a singleton'''
     def __init__(cls, name, bases, dct):
@@ -76,6 +101,13 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
 
      - ``stream_timeout`` (default: ``2``): timeout for stream requests
 
+     - ``stream_chunk_size`` (default: ``8192``): max bytes read from the
+         stream connection at once
+
+     - ``stream_queue_size`` (default: ``0``): max prices buffered per
+         price stream, ``0`` is unbounded. If set, the oldest prices are
+         dropped when the feed falls behind
+
      - ``poll_timeout`` (default: ``2``): timeout for poll requests
 
      - ``reconnections`` (default: ``-1``): try to reconnect forever
@@ -96,6 +128,10 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
         account_poll_freq=5.0,
         # stream timeout
         stream_timeout=2,
+        # max bytes read at once from stream connections
+        stream_chunk_size=8192,
+        # max buffered prices per price stream, 0 unbounded
+        stream_queue_size=0,
         # poll timeout
         poll_timeout=2,
         # count of reconnections, -1 unlimited, 0 none
@@ -112,7 +148,7 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
     # Oanda supported granularities
     '''S5, S10, S15, S30, M1, M2, M3, M4, M5, M10, M15, M30, H1,
     H2, H3, H4, H6, H8, H12, D, W, M'''
-    _GRANULARITIES = {
+    _GRANULARITIES = types.MappingProxyType({
         (bt.TimeFrame.Seconds, 5): 'S5',
         (bt.TimeFrame.Seconds, 10): 'S10',
         (bt.TimeFrame.Seconds, 15): 'S15',
@@ -135,7 +171,7 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
         (bt.TimeFrame.Days, 1): 'D',
         (bt.TimeFrame.Weeks, 1): 'W',
         (bt.TimeFrame.Months, 1): 'M',
-    }
+    })
 
     # Order type matching with oanda
     _ORDEREXECS = {
@@ -146,28 +182,28 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
     }
 
     # transactions which will be emitted on creating/accepting a order
-    _X_CREATE_TRANS = ['MARKET_ORDER',
-                       'LIMIT_ORDER',
-                       'STOP_ORDER',
-                       'TAKE_PROFIT_ORDER',
-                       'STOP_LOSS_ORDER',
-                       'MARKET_IF_TOUCHED_ORDER',
-                       'TRAILING_STOP_LOSS_ORDER']
+    _X_CREATE_TRANS = frozenset(['MARKET_ORDER',
+                                 'LIMIT_ORDER',
+                                 'STOP_ORDER',
+                                 'TAKE_PROFIT_ORDER',
+                                 'STOP_LOSS_ORDER',
+                                 'MARKET_IF_TOUCHED_ORDER',
+                                 'TRAILING_STOP_LOSS_ORDER'])
     # transactions which filled orders
-    _X_FILL_TRANS = ['ORDER_FILL']
+    _X_FILL_TRANS = frozenset(['ORDER_FILL'])
     # transactions which cancelled orders
-    _X_CANCEL_TRANS = ['ORDER_CANCEL']
+    _X_CANCEL_TRANS = frozenset(['ORDER_CANCEL'])
     # transactions which were rejected
-    _X_REJECT_TRANS = ['MARKET_ORDER_REJECT',
-                       'LIMIT_ORDER_REJECT',
-                       'STOP_ORDER_REJECT',
-                       'TAKE_PROFIT_ORDER_REJECT',
-                       'STOP_LOSS_ORDER_REJECT',
-                       'MARKET_IF_TOUCHED_ORDER_REJECT',
-                       'TRAILING_STOP_LOSS_ORDER_REJECT']
+    _X_REJECT_TRANS = frozenset(['MARKET_ORDER_REJECT',
+                                 'LIMIT_ORDER_REJECT',
+                                 'STOP_ORDER_REJECT',
+                                 'TAKE_PROFIT_ORDER_REJECT',
+                                 'STOP_LOSS_ORDER_REJECT',
+                                 'MARKET_IF_TOUCHED_ORDER_REJECT',
+                                 'TRAILING_STOP_LOSS_ORDER_REJECT'])
     # transactions which can be ignored
-    _X_IGNORE_TRANS = ['DAILY_FINANCING',
-                       'CLIENT_CONFIGURE']
+    _X_IGNORE_TRANS = frozenset(['DAILY_FINANCING',
+                                 'CLIENT_CONFIGURE'])
 
     # Date format used
     _DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f000Z'
@@ -177,6 +213,8 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
                  'api-fxpractice.oanda.com']
     _OAPI_STREAM_URL = ['stream-fxtrade.oanda.com',
                         'stream-fxpractice.oanda.com']
+    # seconds instrument details are reused before fetching them again
+    _INSTRUMENT_CACHE_TTL = 3600.0
 
     @classmethod
     def getdata(cls, *args, **kwargs):
@@ -205,12 +243,43 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
 
         self._env = None  # reference to cerebro for general notifications
         self._evt_acct = SerializableEvent()
+        self._evt_stop = SerializableEvent()  # signals end of broker threads
         self._orders = collections.OrderedDict()  # map order.ref to order id
+        self._ordersrev = dict()  # map order.ref to first order id
         self._trades = collections.OrderedDict()  # map order.ref to trade id
-
-        # init oanda v20 api context
-        self.oapi = v20.Context(
-            self._OAPI_URL[int(self.p.practice)],
+        self._instruments = dict()  # instrument details by name with time
+
+        # oanda v20 api endpoints for the selected environment
+        self._rest_host = self._OAPI_URL[1 if self.p.practice else 0]
+        self._stream_host = self._OAPI_STREAM_URL[1 if self.p.practice else 0]
+
+        # oanda v20 api contexts, created on first use
+        self._oapi = None
+        self._oapi_stream = None
+        self._oapi_lock = SerializableLock()
+
+    @property
+    def oapi(self):
+        '''Oanda v20 api context'''
+        if self._oapi is None:
+            with self._oapi_lock:
+                if self._oapi is None:
+                    self._oapi = self._create_oapi()
+        return self._oapi
+
+    @property
+    def oapi_stream(self):
+        '''Oanda v20 api stream context'''
+        if self._oapi_stream is None:
+            with self._oapi_lock:
+                if self._oapi_stream is None:
+                    self._oapi_stream = self._create_oapi_stream()
+        return self._oapi_stream
+
+    def _create_oapi(self):
+        '''Creates the oanda v20 api context'''
+        return v20.Context(
+            self._rest_host,
             poll_timeout=self.p.poll_timeout,
             port=443,
             ssl=True,
@@ -218,10 +287,12 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
             datetime_format='UNIX',
         )
 
-        # init oanda v20 api stream context
-        self.oapi_stream = v20.Context(
-            self._OAPI_STREAM_URL[int(self.p.practice)],
+    def _create_oapi_stream(self):
+        '''Creates the oanda v20 api stream context'''
+        return v20.Context(
+            self._stream_host,
             stream_timeout=self.p.stream_timeout,
+            stream_chunk_size=self.p.stream_chunk_size,
             port=443,
             ssl=True,
             token=self.p.token,
@@ -250,9 +321,8 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
     def stop(self):
         # signal end of thread
         if self.broker is not None:
-            self.q_ordercreate.put(None)
-            self.q_orderclose.put(None)
-            self.q_account.put(None)
+            self.q_orders.put(None)
+            self._evt_stop.set()
 
     def put_notification(self, msg, *args, **kwargs):
         '''Adds a notification'''
@@ -260,8 +330,9 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
 
     def get_notifications(self):
         '''Return the pending "store" notifications'''
-        self.notifs.append(None)  # put a mark / threads could still append
-        return [x for x in iter(self.notifs.popleft, None)]
+        # only take what is there now, threads could still append
+        notifs = self.notifs
+        return [notifs.popleft() for _ in range(len(notifs))]
 
     def get_positions(self):
         '''Returns the currently open positions'''
@@ -289,6 +360,11 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
 
     def get_instrument(self, dataname):
         '''Returns details about the requested instrument'''
+        cached = self._instruments.get(dataname)
+        if (cached is not None
+                and _time.time() - cached[0] < self._INSTRUMENT_CACHE_TTL):
+            return dict(cached[1])
+
         try:
             response = self.oapi.account.instruments(
                 self.p.account,
@@ -305,10 +381,13 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
                     e, response))
 
         try:
-            return inst[0]
+            inst = inst[0]
         except NameError:
             return None
 
+        self._instruments[dataname] = (_time.time(), inst)
+        return dict(inst)
+
     def get_instruments(self, dataname):
         '''Returns details about available instruments'''
         try:
@@ -434,19 +513,15 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
 
     def broker_threads(self):
         '''Creates threads for broker functionality'''
-        self.q_account = queue.Queue()
-        self.q_account.put(True)  # force an immediate update
+        self._evt_stop.clear()
         t = threading.Thread(target=self._t_account)
         t.daemon = True
         t.start()
 
-        self.q_ordercreate = queue.Queue()
-        t = threading.Thread(target=self._t_order_create)
-        t.daemon = True
-        t.start()
-
-        self.q_orderclose = queue.Queue()
-        t = threading.Thread(target=self._t_order_cancel)
+        # a single thread handles order creation and cancellation, this
+        # keeps requests for the same order in the order they were issued
+        self.q_orders = queue.Queue()
+        t = threading.Thread(target=self._t_orders)
         t.daemon = True
         t.start()
 
@@ -464,7 +539,7 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
 
     def streaming_prices(self, dataname):
         '''Creates threads for price streaming'''
-        q = queue.Queue()
+        q = queue.Queue(maxsize=self.p.stream_queue_size)
         kwargs = {'q': q, 'dataname': dataname}
         t = threading.Thread(target=self._t_streaming_prices, kwargs=kwargs)
         t.daemon = True
@@ -542,7 +617,7 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
         ).dict()
 
         okwargs.update(**kwargs)  # anything from the user
-        self.q_ordercreate.put((order.ref, okwargs,))
+        self.q_orders.put((self._order_create, (order.ref, okwargs,)))
 
         # notify orders of being submitted
         self.broker._submit(order.ref)
@@ -555,7 +630,7 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
 
     def order_cancel(self, order):
         '''Cancels a order'''
-        self.q_orderclose.put(order.ref)
+        self.q_orders.put((self._order_cancel, (order.ref,)))
         return order
 
     def candles(self, dataname, dtbegin, dtend, timeframe, compression,
@@ -586,13 +661,6 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
     def _t_account(self):
         '''Callback method for account request'''
         while True:
-            try:
-                msg = self.q_account.get(timeout=self.p.account_poll_freq)
-                if msg is None:
-                    break  # end of thread
-            except queue.Empty:  # tmout -> time to refresh
-                pass
-
             try:
                 response = self.oapi.account.summary(self.p.account)
                 accinfo = response.get('account', 200)
@@ -601,23 +669,26 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
                 if self.p.reconnections == 0:
                     self.put_notification('Giving up fetching account summary')
                     return
-                continue
             except Exception as e:
                 self.put_notification(
                     self._create_error_notif(
                         e, response))
                 return
+            else:
+                try:
+                    self._cash = accinfo.marginAvailable
+                    self._value = accinfo.balance
+                    self._currency = accinfo.currency
+                    self._leverage = 1/accinfo.marginRate
+                except KeyError:
+                    pass
 
-            try:
-                self._cash = accinfo.marginAvailable
-                self._value = accinfo.balance
-                self._currency = accinfo.currency
-                self._leverage = 1/accinfo.marginRate
-            except KeyError:
-                pass
+                # notify of success, initialization waits for it
+                self._evt_acct.set()
 
-            # notify of success, initialization waits for it
-            self._evt_acct.set()
+            # wait for the next refresh, returns early when stopped
+            if self._evt_stop.wait(self.p.account_poll_freq):
+                break  # end of thread
 
     def _t_streaming_events(self, q):
         '''Callback method for streaming events'''
@@ -628,11 +699,18 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
                 response = self.oapi_stream.transaction.stream(
                     self.p.account
                 )
+                # decode lines straight to dicts, building v20 objects
+                # just to convert them back to dicts is not needed
+                response.set_line_parser(json.loads)
                 # process response
-                for msg_type, msg in response.parts():
-                    if msg_type == 'transaction.TransactionHeartbeat':
+                for msg in response.parts():
+                    ttype = msg.get('type')
+                    if ttype is None:
+                        continue  # neither transaction nor heartbeat
+                    heartbeat = ttype == 'HEARTBEAT'
+                    if heartbeat:
                         if not last_id:
-                            last_id = msg.lastTransactionID
+                            last_id = msg['lastTransactionID']
                     # if a reconnection occurred
                     if reconnections > 0:
                         if last_id:
@@ -641,15 +719,15 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
                             old_transactions = self.get_transactions_since(
                                 last_id)
                             for t in old_transactions:
-                                if msg_type == 'transaction.Transaction':
+                                if not heartbeat:
                                     if t.id > last_id:
                                         self._transaction(t.dict())
                                         last_id = t.id
                         reconnections = 0
-                    if msg_type == 'transaction.Transaction':
-                        if not last_id or msg.id > last_id:
-                            self._transaction(msg.dict())
-                            last_id = msg.id
+                    if not heartbeat:
+                        if not last_id or msg['id'] > last_id:
+                            self._transaction(msg)
+                            last_id = msg['id']
 
             except (v20.V20ConnectionError, v20.V20Timeout) as e:
                 self.put_notification(str(e))
@@ -672,25 +750,61 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
 
     def _t_streaming_prices(self, dataname, q):
         '''Callback method for streaming prices'''
+        notif_dropped = 'Price stream for {} full, dropped {} oldest prices'
+        dropped = 0
         try:
             response = self.oapi_stream.pricing.stream(
                 self.p.account,
                 instruments=dataname,
             )
+            # decode lines straight to dicts, as for streaming events
+            response.set_line_parser(json.loads)
             # process response
-            for msg_type, msg in response.parts():
-                if msg_type == 'pricing.ClientPrice':
+            for msg in response.parts():
+                if msg.get('type') == 'PRICE':
                     # put price into queue as dict
-                    q.put(msg.dict())
+                    if self._put_price(q, msg):
+                        # feed is not keeping up, notify on first drop
+                        if not dropped:
+                            self.put_notification(
+                                'Price stream for {} full, dropping oldest '
+                                'prices'.format(dataname))
+                        dropped += 1
+                    elif dropped and q.qsize() <= q.maxsize // 2:
+                        # feed caught up, half of the queue is free again
+                        self.put_notification(
+                            notif_dropped.format(dataname, dropped))
+                        dropped = 0
         except (v20.V20ConnectionError, v20.V20Timeout) as e:
             self.put_notification(str(e))
             # notify feed of error
-            q.put({'msg': 'CONNECTION_ISSUE'})
+            if self._put_price(q, {'msg': 'CONNECTION_ISSUE'}):
+                dropped += 1
         except Exception as e:
             self.put_notification(
                 self._create_error_notif(
                     e, response))
 
+        if dropped:
+            self.put_notification(notif_dropped.format(dataname, dropped))
+
+    def _put_price(self, q, price):
+        '''Puts price into q without blocking, drops the oldest price if q is
+        full. Returns ``True`` if a price was dropped'''
+        try:
+            q.put_nowait(price)
+            return False
+        except queue.Full:
+            pass
+
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            pass  # feed took the price meanwhile
+        # this thread is the only producer, so there is room now
+        q.put_nowait(price)
+        return True
+
     def _t_candles(self, dataname, dtbegin, dtend, timeframe, compression,
                    candleFormat, includeFirst, onlyComplete, q):
         '''Callback method for candles request'''
@@ -778,6 +892,7 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
                 oref = self._client_id_to_oref(trans['clientExtensions']['id'])
             if oref is not None:
                 self._orders[oid] = oref
+                self._ordersrev.setdefault(oref, oid)
 
         elif ttype in self._X_FILL_TRANS:
             # order was filled, notify backtrader of it
@@ -865,74 +980,71 @@ class OandaV20Store(with_metaclass(MetaSingleton, object)):
         if 'tradeClosed' in trans:
             self._trades[oref] = trans['tradeClosed']['tradeID']
         if 'tradesClosed' in trans:
-            for t in trans['tradesClosed']:
-                for key, value in self._trades.copy().items():
-                    if value == t['tradeID']:
-                        del self._trades[key]
+            closed = set(t['tradeID'] for t in trans['tradesClosed'])
+            for key in [k for k, v in self._trades.items() if v in closed]:
+                del self._trades[key]
 
-    def _t_order_create(self):
+    def _t_orders(self):
+        '''Callback method for order creation and cancellation'''
         while True:
-            msg = self.q_ordercreate.get()
+            msg = self.q_orders.get()
             if msg is None:
                 break
 
-            oref, okwargs = msg
+            func, args = msg
             try:
-                if okwargs['replace']:
-                    oid = '@{}'.format(
-                        self._oref_to_client_id(okwargs['replace']))
-                    if okwargs['replace'] in self._trades:
-                        okwargs['tradeID'] = self._trades[okwargs['replace']]
-                    if okwargs['replace_type']:
-                        okwargs['type'] = okwargs['replace_type']
-                    response = self.oapi.order.replace(
-                        self.p.account,
-                        oid,
-                        order=okwargs)
-                else:
-                    response = self.oapi.order.create(
-                        self.p.account,
-                        order=okwargs)
-                # get the transaction which created the order
-                o = response.get('orderCreateTransaction', 201)
-            except (v20.V20ConnectionError, v20.V20Timeout) as e:
-                self.put_notification(str(e))
-                self.broker._reject(oref)
-                continue
+                func(*args)
             except Exception as e:
-                self.put_notification(
-                    self._create_error_notif(
-                        e, response))
-                self.broker._reject(oref)
-                continue
-
-    def _t_order_cancel(self):
-        while True:
-            oref = self.q_orderclose.get()
-            if oref is None:
-                break
+                # keep the worker alive, later orders still need it
+                self.put_notification(str(e))
 
-            oid = None
-            for key, value in self._orders.items():
-                if value == oref:
-                    oid = key
-                    break
+    def _order_create(self, oref, okwargs):
+        try:
+            if okwargs['replace']:
+                oid = '@{}'.format(
+                    self._oref_to_client_id(okwargs['replace']))
+                if okwargs['replace'] in self._trades:
+                    okwargs['tradeID'] = self._trades[okwargs['replace']]
+                if okwargs['replace_type']:
+                    okwargs['type'] = okwargs['replace_type']
+                response = self.oapi.order.replace(
+                    self.p.account,
+                    oid,
+                    order=okwargs)
+            else:
+                response = self.oapi.order.create(
+                    self.p.account,
+                    order=okwargs)
+            # get the transaction which created the order, its id is the
+            # order id, store it so a cancel queued next can find it
+            o = response.get('orderCreateTransaction', 201)
+            self._ordersrev.setdefault(oref, o.id)
+        except (v20.V20ConnectionError, v20.V20Timeout) as e:
+            self.put_notification(str(e))
+            self.broker._reject(oref)
+        except Exception as e:
+            self.put_notification(
+                self._create_error_notif(
+                    e, response))
+            self.broker._reject(oref)
 
-            if oid is None:
-                continue  # the order is no longer there
-            try:
-                # TODO either close pending orders or filled trades
-                response = self.oapi.order.cancel(self.p.account, oid)
-            except (v20.V20ConnectionError, v20.V20Timeout) as e:
-                self.put_notification(str(e))
-                continue
-            except Exception as e:
-                self.put_notification(
-                    self._create_error_notif(
-                        e, response))
-                continue
+    def _order_cancel(self, oref):
+        oid = self._ordersrev.get(oref, None)
+        if oid is None:
+            return  # the order is no longer there
+        try:
+            # TODO either close pending orders or filled trades
+            response = self.oapi.order.cancel(self.p.account, oid)
+        except (v20.V20ConnectionError, v20.V20Timeout) as e:
+            self.put_notification(str(e))
+            return
+        except Exception as e:
+            self.put_notification(
+                self._create_error_notif(
+                    e, response))
+            return
 
-            self.broker._cancel(oref)
+        self.broker._cancel(oref)
 
     def _create_error_notif(self, e, response):
         try: